@@ -1,9 +1,19 @@
 
+import hashlib
 import io
+import os
+import pathlib
+import re
+import tempfile
 import time
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
 import streamlit as st
-from sqlalchemy import create_engine, text
+from openpyxl import Workbook
+from sqlalchemy import bindparam, create_engine, text
 
 st.set_page_config(page_title="Azure MySQL + CSV (Flexible, Metrics+Excel)", layout="wide")
 st.title("📊 Azure MySQL + CSV Uploader (Flexible) — Métricas + Exportar a Excel")
@@ -13,6 +23,9 @@ st.sidebar.header("Fuente de datos")
 source = st.sidebar.radio("Selecciona la fuente", ["MySQL (Azure)", "CSV (subido)"])
 
 # ===== MySQL helpers =====
+# Las agregaciones se calculan en el servidor; solo la tabla detallada trae filas (con LIMIT).
+MYSQL_DETAIL_LIMIT = 5000
+
 def get_engine_from_secrets():
     cfg = st.secrets.get("mysql", {})
     host = cfg.get("host", "")
@@ -33,47 +46,319 @@ def get_engine_from_secrets():
         ```
         """)
         return None
-    return create_engine(
-        f"mysql+mysqlconnector://{user}:{password}@{host}:{port}/{database}",
-        pool_pre_ping=True
-    )
+    return _engine(f"mysql+mysqlconnector://{user}:{password}@{host}:{port}/{database}")
 
-@st.cache_data(ttl=300, show_spinner=False)
-def load_from_mysql():
+@st.cache_resource(show_spinner=False)
+def _engine(url):
+    # Un solo engine (y su pool) por URL, compartido entre reruns y sesiones
+    return create_engine(url, pool_size=5, pool_pre_ping=True, pool_recycle=1800)
+
+def _mysql_where(prod_sel, d0, d1):
+    conds, params, binds = [], {}, []
+    if prod_sel:
+        conds.append("producto IN :prods")
+        params["prods"] = list(prod_sel)
+        binds.append(bindparam("prods", expanding=True))
+    if d0 is not None and d1 is not None:
+        conds.append("fecha >= :d0 AND fecha < :d1")
+        params["d0"], params["d1"] = d0.to_pydatetime(), d1.to_pydatetime()
+    where = ("WHERE " + " AND ".join(conds)) if conds else ""
+    return where, params, binds
+
+def _read_mysql(sql, prod_sel=(), d0=None, d1=None, params=None, **kwargs):
     engine = get_engine_from_secrets()
     if engine is None:
         return None
-    with engine.begin() as con:
-        df = pd.read_sql(
-            text("""
-                SELECT id, nombre, producto, precio, fecha
-                FROM productos
-            """),
-            con,
-            parse_dates=["fecha"],
-        )
-    return df
+    where, where_params, binds = _mysql_where(prod_sel, d0, d1)
+    stmt = text(sql.format(where=where)).bindparams(*binds)
+    with engine.connect() as con:
+        return pd.read_sql(stmt, con, params={**where_params, **(params or {})}, **kwargs)
+
+@st.cache_data(ttl=300, show_spinner=False)
+def load_filters_from_mysql():
+    prods = _read_mysql("""
+        SELECT DISTINCT producto
+        FROM productos
+        WHERE producto IS NOT NULL
+        ORDER BY producto
+    """)
+    if prods is None:
+        return None
+    rango = _read_mysql("""
+        SELECT MIN(fecha) AS min_fecha, MAX(fecha) AS max_fecha
+        FROM productos
+    """, parse_dates=["min_fecha", "max_fecha"])
+    return prods["producto"].astype(str).tolist(), rango.at[0, "min_fecha"], rango.at[0, "max_fecha"]
+
+@st.cache_data(ttl=300, show_spinner=False)
+def load_kpis_from_mysql(prod_sel, d0, d1):
+    df = _read_mysql("""
+        SELECT COUNT(*) AS n, SUM(precio) AS suma, AVG(precio) AS promedio,
+               MIN(precio) AS minimo, MAX(precio) AS maximo
+        FROM productos
+        {where}
+    """, prod_sel, d0, d1)
+    return df.iloc[0].to_dict()
+
+@st.cache_data(ttl=300, show_spinner=False)
+def load_aggregates_from_mysql(prod_sel, d0, d1):
+    df = _read_mysql("""
+        SELECT producto, SUM(precio) AS suma, AVG(precio) AS promedio, COUNT(*) AS n
+        FROM productos
+        {where}
+        GROUP BY producto
+    """, prod_sel, d0, d1)
+    # SUM/AVG llegan como Decimal desde el driver; se pasan a float para nlargest y los gráficos
+    return df.set_index("producto").astype(float)
+
+@st.cache_data(ttl=300, show_spinner=False)
+def load_by_day_from_mysql(prod_sel, d0, d1):
+    df = _read_mysql("""
+        SELECT DATE(fecha) AS dia, AVG(precio) AS precio_promedio, COUNT(*) AS ventas, SUM(precio) AS facturado
+        FROM productos
+        {where}
+        GROUP BY DATE(fecha)
+        ORDER BY dia
+    """, prod_sel, d0, d1, parse_dates=["dia"])
+    return df.dropna(subset=["dia"]).set_index("dia").astype(float)
+
+@st.cache_data(ttl=300, show_spinner=False)
+def load_price_histogram_from_mysql(prod_sel, d0, d1, lo, hi, bins):
+    # Mismos bordes que np.histogram: bins de igual ancho entre el mínimo y el máximo, el último cerrado
+    if lo == hi:
+        lo, hi = lo - 0.5, hi + 0.5
+    width = (hi - lo) / bins
+    df = _read_mysql("""
+        SELECT LEAST(FLOOR((precio - :lo) / :width), :last_bin) AS bin, COUNT(*) AS n
+        FROM productos
+        {where}
+        GROUP BY bin
+    """, prod_sel, d0, d1, params={"lo": lo, "width": width, "last_bin": bins - 1})
+    counts = df.dropna(subset=["bin"]).astype(int).set_index("bin")["n"].reindex(range(bins), fill_value=0)
+    return histogram_frame(counts.to_numpy(), lo + np.arange(bins + 1) * width)
+
+@st.cache_data(ttl=300, show_spinner=False)
+def load_detail_from_mysql(prod_sel, d0, d1, limit=MYSQL_DETAIL_LIMIT):
+    # limit=None trae todas las filas filtradas (solo para las descargas)
+    sql = """
+        SELECT id, nombre, producto, precio, fecha
+        FROM productos
+        {where}
+        ORDER BY fecha DESC
+    """
+    if limit is None:
+        return _read_mysql(sql, prod_sel, d0, d1, parse_dates=["fecha"])
+    return _read_mysql(sql + "LIMIT :limit", prod_sel, d0, d1, params={"limit": int(limit)},
+                       parse_dates=["fecha"])
+
+MYSQL_LOADERS = (
+    load_filters_from_mysql,
+    load_kpis_from_mysql,
+    load_aggregates_from_mysql,
+    load_by_day_from_mysql,
+    load_price_histogram_from_mysql,
+    load_detail_from_mysql,
+)
 
 # ===== CSV helpers =====
+# Lector de Arrow: multihilo y con columnas Arrow; el motor C de pandas queda como último recurso
+_CSV_READ_OPTIONS = pacsv.ReadOptions(use_threads=True)
+# Celdas vacías como nulos también en columnas de texto, igual que pd.read_csv
+_CSV_CONVERT_OPTIONS = pacsv.ConvertOptions(strings_can_be_null=True)
+
+def _read_csv_arrow(file, delimiter):
+    file.seek(0)
+    table = pacsv.read_csv(file, read_options=_CSV_READ_OPTIONS,
+                           parse_options=pacsv.ParseOptions(delimiter=delimiter),
+                           convert_options=_CSV_CONVERT_OPTIONS)
+    return table.to_pandas(types_mapper=pd.ArrowDtype)
+
+def _sniff_sep(file):
+    file.seek(0)
+    header = file.readline().decode("utf-8", errors="ignore")
+    file.seek(0)
+    return ";" if header.count(";") > header.count(",") else ","
+
 def read_csv_safely(file):
+    # El separador se elige por la cabecera; si Arrow rechaza el archivo (filas cortas,
+    # nombres repetidos...) se usa pd.read_csv, que los tolera
+    sep = _sniff_sep(file)
+    try:
+        return _read_csv_arrow(file, sep)
+    except (pa.ArrowInvalid, pa.ArrowNotImplementedError, ValueError):
+        pass
+    file.seek(0)
     try:
-        df = pd.read_csv(file)
+        df = pd.read_csv(file, sep=sep)
     except Exception:
         file.seek(0)
-        df = pd.read_csv(file, sep=';')
+        df = pd.read_csv(file, sep=";" if sep == "," else ",")
     return df
 
 def normalize_datetime(series):
     try:
-        return pd.to_datetime(series)
+        out = pd.to_datetime(series)
+        # Arrow puede inferir timestamp[...]; se pasa a datetime64 para usar el accesor .dt de NumPy
+        if isinstance(out.dtype, pd.ArrowDtype):
+            out = out.astype("datetime64[ns]")
+        return out
     except Exception:
         return series
 
-def coerce_numeric(series):
-    s = series.astype(str).str.replace(r"[^\d,.\-]", "", regex=True)
-    if (s.str.count(",") > 0).sum() > (s.str.count(r"\.") > 0).sum():
-        s = s.str.replace(".", "", regex=False).str.replace(",", ".", regex=False)
-    return pd.to_numeric(s, errors="coerce")
+# Formato decimal: se detecta sobre una muestra y se aplica con str.translate (sin regex por celda)
+_NON_NUMERIC_RE = re.compile(r"[^\d,.\-]")
+_EUROPEAN_TABLE = str.maketrans({".": "", ",": "."})
+_DECIMAL_SAMPLE = 10_000
+_strip_non_numeric = np.frompyfunc(lambda v: _NON_NUMERIC_RE.sub("", str(v)), 1, 1)
+_to_dot_decimal = np.frompyfunc(lambda v: v.translate(_EUROPEAN_TABLE), 1, 1)
+
+def _is_european(stripped):
+    sample = [v for v in stripped[:_DECIMAL_SAMPLE] if v]
+    return sum("," in v for v in sample) > sum("." in v for v in sample)
+
+def detect_european(series):
+    return _is_european(_strip_non_numeric(series.to_numpy(dtype=object, copy=False)[:_DECIMAL_SAMPLE]))
+
+def coerce_numeric(series, european=None):
+    # european=None detecta el formato en esta serie; los bloques de un CSV grande pasan el del primero
+    if pd.api.types.is_numeric_dtype(series) and not pd.api.types.is_bool_dtype(series):
+        # Los lectores sí parsean "inf"; se trata como no numérico, igual que en la ruta de texto
+        return series.astype("float64").replace([np.inf, -np.inf], np.nan)
+    arr = _strip_non_numeric(series.to_numpy(dtype=object, copy=False))
+    if european is None:
+        european = _is_european(arr)
+    if european:
+        arr = _to_dot_decimal(arr)
+    return pd.to_numeric(pd.Series(arr, index=series.index), errors="coerce").astype("float64")
+
+# Las cachés del CSV se indexan por el file_id de la subida; los bytes van sin hashear (_file_bytes)
+@st.cache_data(show_spinner=False)
+def load_csv(csv_key, _file_bytes):
+    return read_csv_safely(io.BytesIO(_file_bytes))
+
+@st.cache_data(show_spinner=False)
+def csv_columns(csv_key, _file_bytes):
+    return list(load_csv(csv_key, _file_bytes).columns)
+
+def normalize_frame(df, mapping, id_start=1, european=None):
+    c_id, c_nombre, c_prod, c_precio, c_fecha = mapping
+    id_dtype = np.int32 if id_start + len(df) <= np.iinfo(np.int32).max else np.int64
+    # Un solo constructor (sin consolidaciones por asignación); nombre en Arrow y producto categórico
+    return pd.DataFrame({
+        "id": df[c_id] if c_id != "(ninguna)" else np.arange(id_start, id_start + len(df), dtype=id_dtype),
+        "nombre": (df[c_nombre].astype("string[pyarrow]") if c_nombre != "(ninguna)"
+                   else pd.array([None] * len(df), dtype="string[pyarrow]")),
+        "producto": df[c_prod].astype("category"),
+        # precio queda en float64: en float32 las sumas por producto/día pierden precisión
+        "precio": coerce_numeric(df[c_precio], european=european),
+        "fecha": normalize_datetime(df[c_fecha]) if c_fecha != "(ninguna)" else pd.NaT,
+    }, index=df.index)
+
+@st.cache_data(show_spinner=False)
+def build_ndf(csv_key, mapping, _file_bytes):
+    # CSV -> frame normalizado; solo se recalcula si cambia la subida o el mapeo
+    return normalize_frame(load_csv(csv_key, _file_bytes), mapping)
+
+# ===== CSV grande: agregación por bloques =====
+# Sobre este tamaño no se materializa el CSV: se agregan parciales por (producto, día) bloque a bloque
+STREAM_THRESHOLD_BYTES = 100 * 1024 * 1024
+STREAM_CHUNK_ROWS = 200_000
+STREAM_DETAIL_ROWS = 5000
+
+@st.cache_data(show_spinner=False)
+def stream_csv_columns(file_id, _file):
+    return list(pd.read_csv(_file, sep=_sniff_sep(_file), nrows=0).columns)
+
+@st.cache_data(show_spinner=False)
+def stream_build_aggregates(file_id, mapping, _file):
+    parts, detail, n_detail, offset = [], [], 0, 0
+    # precio se lee como texto y el formato decimal se fija con el primer bloque, para que "1.234"
+    # signifique lo mismo en todos los bloques
+    c_precio = mapping[3]
+    european = None
+    for chunk in pd.read_csv(_file, sep=_sniff_sep(_file), chunksize=STREAM_CHUNK_ROWS, dtype={c_precio: str}):
+        if european is None:
+            european = detect_european(chunk[c_precio])
+        part = normalize_frame(chunk, mapping, id_start=offset + 1, european=european)
+        offset += len(part)
+        if n_detail < STREAM_DETAIL_ROWS:
+            detail.append(part.head(STREAM_DETAIL_ROWS - n_detail))
+            n_detail += len(detail[-1])
+        if pd.api.types.is_datetime64_any_dtype(part["fecha"]):
+            dia = part["fecha"].dt.normalize()
+        else:
+            dia = pd.Series(pd.NaT, index=part.index, dtype="datetime64[ns]")
+        parts.append(part.groupby([part["producto"].astype(object), dia.rename("dia")], dropna=False).agg(
+            suma=("precio", "sum"),
+            n=("precio", "size"),
+            n_precio=("precio", "count"),
+            maximo=("precio", "max"),
+        ))
+    # Combinación de parciales: sumas y conteos se suman, el máximo se toma sobre los máximos
+    combined = pd.concat(parts).groupby(level=["producto", "dia"], dropna=False).agg(
+        {"suma": "sum", "n": "sum", "n_precio": "sum", "maximo": "max"}
+    )
+    # Cada bloque trae sus propias categorías; se re-categoriza la muestra ya unida
+    return combined.reset_index(), pd.concat(detail).astype({"producto": "category"})
+
+def summarize_partials(parts):
+    n_precio = parts["n_precio"].sum()
+    kpi = {
+        "n": parts["n"].sum(),
+        "suma": parts["suma"].sum(),
+        "promedio": parts["suma"].sum() / n_precio if n_precio else float("nan"),
+        "maximo": parts["maximo"].max(),
+    }
+    agg_all = parts.groupby("producto", dropna=False, sort=False).agg(
+        suma=("suma", "sum"), n_precio=("n_precio", "sum"), n=("n", "sum")
+    )
+    agg_all.insert(1, "promedio", agg_all["suma"] / agg_all.pop("n_precio"))
+    by_day = parts.dropna(subset=["dia"]).groupby("dia", sort=True).agg(
+        facturado=("suma", "sum"), n_precio=("n_precio", "sum"), ventas=("n", "sum")
+    )
+    by_day.insert(0, "precio_promedio", by_day["facturado"] / by_day.pop("n_precio"))
+    return kpi, agg_all, by_day
+
+# ===== Cache helpers =====
+def frame_hash(df):
+    # Clave exacta para las exportaciones: hash de todas las filas (vectorizado), columnas y dtypes
+    h = hashlib.md5(repr((list(df.columns), [str(t) for t in df.dtypes])).encode())
+    h.update(pd.util.hash_pandas_object(df, index=False).to_numpy().tobytes())
+    return h.hexdigest()
+
+@st.cache_data(show_spinner=False)
+def product_aggregates(filter_state, _df):
+    # Una sola pasada calcula las tres métricas; cambiar de métrica solo elige columna
+    return _df.groupby("producto", dropna=False, observed=True, sort=False).agg(
+        suma=("precio", "sum"),
+        promedio=("precio", "mean"),
+        n=("id", "count"),
+    )
+
+@st.cache_data(show_spinner=False)
+def kpis(filter_state, _precio):
+    # Reducciones NumPy sobre el buffer contiguo; los NaN (precios no parseables) se descartan como en pandas
+    valid = _precio[~np.isnan(_precio)]
+    if not valid.size:
+        return {"n": _precio.size, "suma": 0.0, "promedio": float("nan"), "maximo": float("nan")}
+    suma = valid.sum(dtype=np.float64)
+    return {"n": _precio.size, "suma": suma, "promedio": suma / valid.size, "maximo": valid.max()}
+
+@st.cache_data(show_spinner=False)
+def fecha_range(range_key, _fecha):
+    # range_key = (subida, mapeo, productos): el rango solo cambia cuando cambia la selección
+    return _fecha.min(), _fecha.max()
+
+METRICAS = {
+    "Suma (precio)": ("suma", "Suma de precio"),
+    "Promedio (precio)": ("promedio", "Precio promedio"),
+    "Conteo (registros)": ("n", "Conteo"),
+}
+
+HIST_BINS = 50
+
+def histogram_frame(counts, edges):
+    return pd.DataFrame({"precio": (edges[:-1] + edges[1:]) / 2, "n": counts}).set_index("precio")
 
 # Subida CSV
 uploaded_file = None
@@ -83,112 +368,155 @@ if source == "CSV (subido)":
 # Botón actualizar
 colA, colB = st.columns([1, 5])
 with colA:
-    if st.button("🔄 Actualizar"):
-        load_from_mysql.clear()
-        st.experimental_rerun()
+    # El clic ya provoca un rerun; basta con limpiar las cachés de MySQL antes de que se consulten.
+    # Las cachés del CSV y de las exportaciones no se tocan.
+    if source == "MySQL (Azure)" and st.button("🔄 Actualizar"):
+        for loader in MYSQL_LOADERS:
+            loader.clear()
 
 # Carga de datos
-df = None
+file_bytes = None
+mysql_filtros = None
+streaming = False
 if source == "MySQL (Azure)":
     with st.spinner("Conectando a MySQL en Azure..."):
-        df = load_from_mysql()
-        if df is None:
+        mysql_filtros = load_filters_from_mysql()
+        if mysql_filtros is None:
             st.stop()
 elif source == "CSV (subido)":
     if uploaded_file is not None:
+        streaming = uploaded_file.size > STREAM_THRESHOLD_BYTES
+        csv_key = uploaded_file.file_id
         with st.spinner("Leyendo CSV..."):
-            df = read_csv_safely(uploaded_file)
+            if streaming:
+                cols = stream_csv_columns(csv_key, uploaded_file)
+            else:
+                file_bytes = uploaded_file.getvalue()
+                cols = csv_columns(csv_key, file_bytes)
     else:
         st.info("Sube un archivo CSV para continuar.")
         st.stop()
 
 # Mapeo de columnas
-st.sidebar.header("Mapeo de columnas (CSV)")
-cols = list(df.columns)
-
-def pick(label, default_candidates):
-    found = None
-    lower = {c.lower(): c for c in cols}
-    for cand in default_candidates:
-        if cand in lower:
-            found = lower[cand]
-            break
-    return st.sidebar.selectbox(f"{label}:", ["(ninguna)"] + cols, index=(cols.index(found)+1) if found else 0)
-
+ndf = None
+stream_aggs = None
 if source == "CSV (subido)":
+    st.sidebar.header("Mapeo de columnas (CSV)")
+
+    def pick(label, default_candidates):
+        found = None
+        lower = {c.lower(): c for c in cols}
+        for cand in default_candidates:
+            if cand in lower:
+                found = lower[cand]
+                break
+        return st.sidebar.selectbox(f"{label}:", ["(ninguna)"] + cols, index=(cols.index(found)+1) if found else 0)
+
     c_id      = pick("ID (opcional)", ["id"])
     c_nombre  = pick("Nombre (opcional)", ["nombre", "cliente", "user", "buyer"])
     c_prod    = pick("Producto (requerido)", ["producto", "item", "product", "categoria"])
     c_precio  = pick("Precio (requerido)", ["precio", "amount", "price", "total"])
     c_fecha   = pick("Fecha (opcional)", ["fecha", "date", "timestamp", "datetime"])
-else:
-    c_id, c_nombre, c_prod, c_precio, c_fecha = "id", "nombre", "producto", "precio", "fecha"
 
-if (c_prod == "(ninguna)") or (c_precio == "(ninguna)"):
-    st.error("Debes mapear al menos **Producto** y **Precio**.")
-    st.stop()
+    if (c_prod == "(ninguna)") or (c_precio == "(ninguna)"):
+        st.error("Debes mapear al menos **Producto** y **Precio**.")
+        st.stop()
 
-ndf = pd.DataFrame()
-if c_id != "(ninguna)":
-    ndf["id"] = df[c_id]
-else:
-    ndf["id"] = range(1, len(df) + 1)
-if c_nombre != "(ninguna)":
-    ndf["nombre"] = df[c_nombre]
-else:
-    ndf["nombre"] = None
-ndf["producto"] = df[c_prod]
-ndf["precio"] = coerce_numeric(df[c_precio])
-if c_fecha != "(ninguna)":
-    ndf["fecha"] = normalize_datetime(df[c_fecha])
-else:
-    ndf["fecha"] = pd.NaT
+    mapping = (c_id, c_nombre, c_prod, c_precio, c_fecha)
+    if streaming:
+        # ndf queda como la muestra de detalle; los agregados cubren el archivo completo
+        with st.spinner("Agregando CSV por bloques..."):
+            stream_aggs, ndf = stream_build_aggregates(csv_key, mapping, uploaded_file)
+    else:
+        with st.spinner("Procesando CSV..."):
+            ndf = build_ndf(csv_key, mapping, file_bytes)
 
 # ===== Panel de métricas =====
 st.sidebar.header("Opciones de Métrica")
-metric_choice = st.sidebar.selectbox("Métrica para Totales por producto", ["Suma (precio)", "Promedio (precio)", "Conteo (registros)"])
+metric_choice = st.sidebar.selectbox("Métrica para Totales por producto", list(METRICAS))
 
 # Filtros
 st.sidebar.header("Filtros")
-prods = sorted(pd.Series(ndf["producto"]).dropna().astype(str).unique().tolist())
+if source == "MySQL (Azure)":
+    prods, min_date, max_date = mysql_filtros
+elif streaming:
+    prods = sorted(stream_aggs["producto"].dropna().astype(str).unique().tolist())
+else:
+    # Las categorías ya son los valores únicos (ordenados, sin NaN) de producto
+    prods = ndf["producto"].cat.categories.astype(str).tolist()
 default_sel = prods[:5] if prods else []
 prod_sel = st.sidebar.multiselect("Producto", prods, default=default_sel)
 
-df_f = ndf.copy()
-if prod_sel:
-    df_f = df_f[df_f["producto"].astype(str).isin([str(x) for x in prod_sel])]
+df_f = None
+if ndf is not None:
+    df_f = ndf
+    if prod_sel:
+        # Filtro sobre los códigos de la categoría: se compara contra n_categorías, no n_filas
+        cat = ndf["producto"].cat
+        sel_codes = np.flatnonzero(np.isin(cat.categories.astype(str), [str(x) for x in prod_sel]))
+        df_f = ndf[np.isin(cat.codes.to_numpy(), sel_codes)]
+    # fecha ya viene normalizada desde build_ndf (sin to_datetime); el rango se memoiza por selección
+    fecha_has_any = pd.api.types.is_datetime64_any_dtype(ndf["fecha"]) and ndf["fecha"].notna().any()
+    min_date = max_date = pd.NaT
+    if fecha_has_any and not streaming:
+        min_date, max_date = fecha_range((csv_key, mapping, tuple(prod_sel)), df_f["fecha"])
+if streaming:
+    s_f = stream_aggs
+    if prod_sel:
+        s_f = s_f[s_f["producto"].astype(str).isin([str(x) for x in prod_sel])]
+    min_date, max_date = s_f["dia"].min(), s_f["dia"].max()
 
-if df_f["fecha"].notna().any():
-    min_date = pd.to_datetime(df_f["fecha"]).min()
-    max_date = pd.to_datetime(df_f["fecha"]).max()
-    if pd.notna(min_date) and pd.notna(max_date) and min_date != max_date:
-        date_range = st.sidebar.date_input("Rango de fechas", (min_date.date(), max_date.date()))
-        if isinstance(date_range, tuple) and len(date_range) == 2:
-            d0, d1 = pd.to_datetime(date_range[0]), pd.to_datetime(date_range[1])
-            df_f = df_f[(df_f["fecha"] >= d0) & (df_f["fecha"] <= d1 + pd.Timedelta(days=1))]
+d0 = d1 = None
+if pd.notna(min_date) and pd.notna(max_date) and min_date != max_date:
+    date_range = st.sidebar.date_input("Rango de fechas", (min_date.date(), max_date.date()))
+    if isinstance(date_range, tuple) and len(date_range) == 2:
+        # Rango semiabierto [d0, d1): d1 es la medianoche posterior al último día elegido (mismo criterio en todas las fuentes)
+        d0, d1 = pd.to_datetime(date_range[0]), pd.to_datetime(date_range[1]) + pd.Timedelta(days=1)
+
+# Agregados: en MySQL se calculan en el servidor; en CSV, con pandas sobre el filtrado
+if source == "MySQL (Azure)":
+    sel = tuple(prod_sel)
+    with st.spinner("Consultando agregados en MySQL..."):
+        kpi = load_kpis_from_mysql(sel, d0, d1)
+        agg_all = load_aggregates_from_mysql(sel, d0, d1)
+        by_day = load_by_day_from_mysql(sel, d0, d1)
+        df_f = load_detail_from_mysql(sel, d0, d1)
+elif streaming:
+    if d0 is not None:
+        s_f = s_f[(s_f["dia"] >= d0) & (s_f["dia"] < d1)]
+        if fecha_has_any:
+            df_f = df_f[(df_f["fecha"] >= d0) & (df_f["fecha"] < d1)]
+    kpi, agg_all, by_day = summarize_partials(s_f)
+else:
+    if d0 is not None:
+        df_f = df_f[(df_f["fecha"] >= d0) & (df_f["fecha"] < d1)]
+    # Estado exacto del filtro (subida, mapeo, productos, fechas) como clave de los agregados cacheados
+    filter_state = (csv_key, mapping, tuple(prod_sel), d0, d1)
+    kpi = kpis(filter_state, df_f["precio"].to_numpy())
+    agg_all = product_aggregates(filter_state, df_f)
+    by_day = None
+    if fecha_has_any and df_f["fecha"].notna().any():
+        # La clave diaria se pasa directa al groupby (datetime64), sin copiar df_f
+        by_day = df_f.groupby(df_f["fecha"].dt.floor("D").rename("dia"), sort=True).agg(
+            precio_promedio=("precio", "mean"),
+            ventas=("id", "count"),
+            facturado=("precio", "sum")
+        )
 
 # KPIs
 col1, col2, col3, col4 = st.columns(4)
-col1.metric("Registros", f"{len(df_f):,}")
-col2.metric("Total facturado", f"${df_f['precio'].sum():,.2f}")
-col3.metric("Precio promedio", f"${df_f['precio'].mean():.2f}")
-col4.metric("Precio máx.", f"${df_f['precio'].max():,.2f}")
+col1.metric("Registros", f"{int(kpi['n']):,}")
+col2.metric("Total facturado", f"${kpi['suma'] or 0:,.2f}")
+col3.metric("Precio promedio", f"${kpi['promedio'] or 0:.2f}")
+col4.metric("Precio máx.", f"${kpi['maximo'] or 0:,.2f}")
 
 # Totales por producto con selector de métrica
 st.subheader("Totales por producto (según métrica)")
-if metric_choice == "Suma (precio)":
-    agg = df_f.groupby("producto", dropna=False).agg(valor=("precio", "sum"), n=("id", "count"))
-    y_label = "Suma de precio"
-elif metric_choice == "Promedio (precio)":
-    agg = df_f.groupby("producto", dropna=False).agg(valor=("precio", "mean"), n=("id", "count"))
-    y_label = "Precio promedio"
-else:  # Conteo
-    agg = df_f.groupby("producto", dropna=False).agg(valor=("id", "count"), n=("id", "count"))
-    y_label = "Conteo"
-
-agg = agg.sort_values("valor", ascending=False)
+metric_col, y_label = METRICAS[metric_choice]
+agg = agg_all[[metric_col]].rename(columns={metric_col: "valor"}).assign(n=agg_all["n"])
+
 top_n = st.slider("Top N", min_value=3, max_value=30, value=10, step=1)
-agg_top = agg.head(top_n)
+agg_top = agg.nlargest(top_n, "valor")
 
 c1, c2 = st.columns(2)
 with c1:
@@ -197,15 +525,8 @@ with c2:
     st.bar_chart(agg_top["n"])
 
 # Series de tiempo
-if df_f["fecha"].notna().any():
+if by_day is not None and not by_day.empty:
     st.subheader("Evolución temporal")
-    df_t = df_f.copy()
-    df_t["__day__"] = pd.to_datetime(df_t["fecha"]).dt.date
-    by_day = df_t.groupby("__day__").agg(
-        precio_promedio=("precio", "mean"),
-        ventas=("id", "count"),
-        facturado=("precio", "sum")
-    )
     c3, c4 = st.columns(2)
     with c3:
         st.line_chart(by_day["facturado"])
@@ -216,27 +537,109 @@ else:
 
 # Distribución
 st.subheader("Distribución de precios")
-st.bar_chart(df_f["precio"].dropna())
+# Histograma calculado en el servidor: se envían ~50 barras en lugar de un valor por fila
+hist_df = None
+if source == "MySQL (Azure)":
+    # En MySQL se agrupa por bin en la base, sobre todas las filas filtradas (no la muestra de detalle)
+    if pd.notna(kpi["minimo"]) and pd.notna(kpi["maximo"]):
+        hist_df = load_price_histogram_from_mysql(sel, d0, d1, float(kpi["minimo"]), float(kpi["maximo"]), HIST_BINS)
+else:
+    precios = pd.to_numeric(df_f["precio"], errors="coerce").to_numpy(dtype="float64")
+    precios = precios[np.isfinite(precios)]
+    if precios.size:
+        hist_df = histogram_frame(*np.histogram(precios, bins=HIST_BINS))
+if hist_df is not None:
+    st.bar_chart(hist_df)
+else:
+    st.info("No hay precios válidos para la distribución.")
 
 # Tabla + descargas
 st.subheader("Tabla detallada (filtrada)")
-st.dataframe(df_f.sort_values(by=["fecha"] if df_f["fecha"].notna().any() else ["id"],
-                              ascending=False),
-             use_container_width=True, height=420)
+if source == "MySQL (Azure)":
+    st.caption(f"Mostrando hasta {MYSQL_DETAIL_LIMIT:,} registros más recientes; métricas, gráficos e histograma usan el total en MySQL.")
+elif streaming:
+    st.caption(f"CSV grande: tabla, histograma de precios y descargas usan los primeros {STREAM_DETAIL_ROWS:,} registros; "
+               "métricas y demás gráficos usan el archivo completo.")
+# Al navegador solo se envía una ventana de filas. El tope es lo que realmente hay en df_f
+# (en MySQL y en CSV grande df_f ya es la muestra de detalle).
+max_show = max(1, min(len(df_f), 50_000))
+n_show = st.number_input("Filas a mostrar", min_value=1, max_value=max_show, value=min(5000, max_show), step=1000)
+view = df_f.sort_values(by=["fecha"] if df_f["fecha"].notna().any() else ["id"],
+                        ascending=False, kind="mergesort").head(int(n_show))
+st.dataframe(view, use_container_width=True, height=420)
+
+# Descargas: en MySQL df_f es la muestra con LIMIT; las filas completas se piden solo si el usuario lo marca
+df_export = df_f
+export_note = ""
+if source == "MySQL (Azure)":
+    if st.checkbox("Incluir todas las filas filtradas en las descargas (consulta completa a MySQL)"):
+        with st.spinner("Descargando filas filtradas de MySQL..."):
+            df_export = load_detail_from_mysql(sel, d0, d1, limit=None)
+    else:
+        export_note = f" — primeros {MYSQL_DETAIL_LIMIT:,}"
+elif streaming:
+    export_note = f" — primeros {STREAM_DETAIL_ROWS:,}"
+export_key = frame_hash(df_export)
+# Los bytes exportados pueden pesar tanto como el filtrado: solo se guardan los últimos estados
+EXPORT_CACHE_ENTRIES = 4
 
 # Descarga CSV
-csv_bytes = df_f.to_csv(index=False).encode("utf-8")
-st.download_button("⬇️ Descargar filtrado (CSV)", data=csv_bytes, file_name="filtrado.csv", mime="text/csv")
+def _csv_timestamp(col):
+    # Mismo texto que to_csv: solo fecha si todo cae a medianoche, si no segundos (sin los ...000000000 de ns)
+    if col.type.tz is None and pc.all(pc.equal(pc.floor_temporal(col, unit="day"), col)).as_py() is not False:
+        return col.cast(pa.date32())
+    try:
+        return col.cast(pa.timestamp("s", tz=col.type.tz))
+    except pa.ArrowInvalid:
+        return col
 
-# Descarga Excel (xlsx)
-@st.cache_data
-def to_excel_bytes(df):
+@st.cache_data(show_spinner=False, max_entries=EXPORT_CACHE_ENTRIES)
+def to_csv_bytes(export_key, _df):
+    # El writer de Arrow genera UTF-8 directamente (sin str intermedio ni copia a bytes)
+    table = pa.Table.from_pandas(_df, preserve_index=False)
+    for i, field in enumerate(table.schema):
+        if pa.types.is_dictionary(field.type):
+            table = table.set_column(i, field.name, table.column(i).cast(field.type.value_type))
+        elif pa.types.is_timestamp(field.type):
+            table = table.set_column(i, field.name, _csv_timestamp(table.column(i)))
     output = io.BytesIO()
-    with pd.ExcelWriter(output, engine="xlsxwriter") as writer:
-        df.to_excel(writer, index=False, sheet_name="filtrado")
+    pacsv.write_csv(table, output)
     return output.getvalue()
 
-xlsx_bytes = to_excel_bytes(df_f)
-st.download_button("⬇️ Descargar filtrado (Excel)", data=xlsx_bytes, file_name="filtrado.xlsx", mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
+csv_bytes = to_csv_bytes(export_key, df_export)
+st.download_button(f"⬇️ Descargar filtrado (CSV){export_note}", data=csv_bytes, file_name="filtrado.csv", mime="text/csv")
+
+# Descarga Excel (xlsx)
+# openpyxl en modo write_only escribe fila a fila (usa lxml si está disponible); se convierte por bloques
+EXCEL_CHUNK_ROWS = 10_000
+
+def _excel_rows(df):
+    for start in range(0, len(df), EXCEL_CHUNK_ROWS):
+        cols = []
+        for _, col in df.iloc[start:start + EXCEL_CHUNK_ROWS].items():
+            if isinstance(col.dtype, pd.DatetimeTZDtype):
+                col = col.dt.tz_localize(None)
+            col = col.astype(object)
+            cols.append(col.where(col.notna(), None).to_numpy())
+        yield from zip(*cols)
+
+@st.cache_data(show_spinner=False, max_entries=EXPORT_CACHE_ENTRIES)
+def to_excel_bytes(export_key, _df):
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("filtrado")
+    ws.append(list(_df.columns))
+    for row in _excel_rows(_df):
+        ws.append(row)
+    # El ZIP final se escribe a disco en vez de a BytesIO para no duplicar el pico de memoria
+    with tempfile.NamedTemporaryFile(suffix=".xlsx", delete=False) as tmp:
+        tmp_path = pathlib.Path(tmp.name)
+    try:
+        wb.save(tmp_path)
+        return tmp_path.read_bytes()
+    finally:
+        os.unlink(tmp_path)
+
+xlsx_bytes = to_excel_bytes(export_key, df_export)
+st.download_button(f"⬇️ Descargar filtrado (Excel){export_note}", data=xlsx_bytes, file_name="filtrado.xlsx", mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
 
-st.caption("Fuente: {}. Mapeo flexible para CSV. Botón 'Actualizar' limpia caché de MySQL y recarga.".format(source))
+st.caption("Fuente: {}. Mapeo flexible para CSV. Agregados de MySQL calculados en el servidor. Botón 'Actualizar' limpia caché de MySQL y recarga.".format(source))